@@ -6,23 +6,114 @@ Provides full email reading, sending, and management capabilities
 
 import os
 import sys
+import fcntl
 import json
 import base64
+import binascii
 import email
+import sqlite3
+import time
+import random
+import threading
+from collections import deque
+from itertools import chain, islice
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Gmail API imports
+import google_auth_httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+# Optional: faster JSON for the message cache and --format json output
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Refresh the OAuth token this long before it expires
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# messages.list page size; smaller pages let batch fetches start sooner
+PAGE_SIZE = 100
+# Gmail rejects batch requests with more than 100 sub-requests
+BATCH_SIZE = 100
+# Batch sub-request statuses worth retrying, and how often / how long to back off
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_BATCH_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+# messages.batchModify accepts at most 1000 IDs per call
+MODIFY_BATCH_SIZE = 1000
+# Label applied by mark-processed and excluded from keyword searches
+PROCESSED_LABEL = 'Processed-Agent'
+# Cap on messages.get sub-requests in flight across pooled batches, so Gmail's
+# per-user rate limit isn't tripped; pooled batches are sized to fit under it
+MAX_IN_FLIGHT_REQUESTS = 20
+MAX_CONCURRENT_BATCHES = 2
+POOLED_BATCH_SIZE = MAX_IN_FLIGHT_REQUESTS // MAX_CONCURRENT_BATCHES
+# Headers requested when listing messages in metadata format
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+# Body mimetypes in order of preference (lower wins)
+BODY_MIME_PRIORITY = {'text/plain': 0, 'text/html': 1}
+# A preferred body shorter than this (decoded chars) may be a stub...
+STUB_BODY_CHARS = 200
+# ...and is replaced only by an alternative at least this many times larger
+STUB_SIZE_RATIO = 10
+
+# Maps the base64url alphabet onto standard base64 for binascii
+_B64URL_TRANS = bytes.maketrans(b'-_', b'+/')
+
+def _b64url_decode(data):
+    """Decode Gmail's base64url body data, tolerating missing padding"""
+    # Extra '=' is ignored by binascii, so unpadded data decodes without a length check
+    return binascii.a2b_base64(data.encode('ascii').translate(_B64URL_TRANS) + b'==')
+
+@functools.lru_cache(maxsize=1)
+def _load_flow(credentials_path, scopes):
+    """Read client secrets and build the installed-app OAuth flow"""
+    flow = InstalledAppFlow.from_client_secrets_file(credentials_path, list(scopes))
+    flow.redirect_uri = 'http://localhost'
+    return flow
+
+def _json_dumps(obj):
+    """Serialize to compact JSON text, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+def _json_loads(data):
+    """Parse JSON text, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+SUPPORT_KEYWORDS = [
+    'support', 'help', 'issue', 'problem', 'bug', 'question',
+    'inquiry', 'contact', 'assistance', 'trouble'
+]
+INVESTOR_KEYWORDS = [
+    'investment', 'funding', 'investor', 'venture', 'capital',
+    'partnership', 'acquisition', 'valuation', 'pitch', 'deck'
+]
+
+def _keyword_query(keywords):
+    """Build a Gmail query matching any keyword in the subject or body"""
+    return '(' + ' OR '.join(f'subject:{k} OR "{k}"' for k in keywords) + ')'
+
+CUSTOMER_SUPPORT_QUERY = _keyword_query(SUPPORT_KEYWORDS)
+INVESTOR_QUERY = _keyword_query(INVESTOR_KEYWORDS)
+
 class GmailAPI:
+    WANTED_HEADERS = frozenset({'date', 'from', 'to', 'subject'})
+    
     def __init__(self):
         self.SCOPES = [
             'https://www.googleapis.com/auth/gmail.readonly',
@@ -31,6 +122,11 @@ class GmailAPI:
             'https://www.googleapis.com/auth/gmail.modify'
         ]
         self.service = None
+        self.creds = None
+        self._cache = None
+        self._local = threading.local()
+        # Message IDs that could not be fetched, so callers can report them
+        self.failed_message_ids = []
         self.creds_dir = Path.home() / '.claude' / 'gmail'
         self.creds_dir.mkdir(parents=True, exist_ok=True)
         
@@ -40,55 +136,90 @@ class GmailAPI:
         token_path = self.creds_dir / 'token.json'
         credentials_path = self.creds_dir / 'credentials.json'
         
-        # Load existing token
+        # Load existing token, refreshing it ahead of expiry
         if token_path.exists():
             creds = Credentials.from_authorized_user_file(str(token_path), self.SCOPES)
+            if creds.refresh_token and self._needs_refresh(creds):
+                creds = self._refresh_token(token_path)
         
         # If no valid credentials, get new ones
         if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                if not credentials_path.exists():
-                    print(f"❌ Gmail credentials not found!")
-                    print(f"Please download 'credentials.json' from Google Cloud Console and place it at:")
-                    print(f"   {credentials_path}")
-                    print(f"\nSetup Guide:")
-                    print(f"1. Go to https://console.cloud.google.com/")
-                    print(f"2. Create/select project")  
-                    print(f"3. Enable Gmail API")
-                    print(f"4. Create OAuth 2.0 credentials (Desktop application)")
-                    print(f"5. Download credentials.json")
-                    return False
+            if not credentials_path.exists():
+                print(f"❌ Gmail credentials not found!")
+                print(f"Please download 'credentials.json' from Google Cloud Console and place it at:")
+                print(f"   {credentials_path}")
+                print(f"\nSetup Guide:")
+                print(f"1. Go to https://console.cloud.google.com/")
+                print(f"2. Create/select project")  
+                print(f"3. Enable Gmail API")
+                print(f"4. Create OAuth 2.0 credentials (Desktop application)")
+                print(f"5. Download credentials.json")
+                return False
                     
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    str(credentials_path), self.SCOPES)
+            flow = self._flow()
                 
-                # Try manual flow for headless environments
-                try:
-                    creds = flow.run_local_server(port=0)
-                except Exception as e:
-                    print("❌ Local server authentication failed (headless environment)")
-                    print("📋 Manual OAuth setup required:")
-                    print(f"1. Go to: {flow.authorization_url()[0]}")
-                    print("2. Authorize the application")
-                    print("3. Copy the authorization code")
-                    print("4. Run: ./lib/gmail-fetch.sh auth-code <CODE>")
-                    return False
+            # Try manual flow for headless environments
+            try:
+                creds = flow.run_local_server(port=0)
+            except Exception as e:
+                print("❌ Local server authentication failed (headless environment)")
+                print("📋 Manual OAuth setup required:")
+                print(f"1. Go to: {flow.authorization_url()[0]}")
+                print("2. Authorize the application")
+                print("3. Copy the authorization code")
+                print("4. Run: ./lib/gmail-fetch.sh auth-code <CODE>")
+                return False
             
             # Save credentials for next run
-            with open(token_path, 'w') as token:
-                token.write(creds.to_json())
+            self._save_token(creds, token_path)
         
         try:
-            self.service = build('gmail', 'v1', credentials=creds)
+            self.creds = creds
+            # Use the discovery document bundled with google-api-python-client >= 2.0
+            # instead of fetching it; with a static document the file cache is unused
+            self.service = build('gmail', 'v1', credentials=creds,
+                                 static_discovery=True, cache_discovery=False)
             return True
         except Exception as e:
             print(f"❌ Gmail API authentication failed: {e}")
             return False
     
-    def get_unread_emails(self, limit=10, sender_filter=None, subject_filter=None):
-        """Get unread emails with optional filters"""
+    def _flow(self):
+        """OAuth flow for credentials.json, built once per credentials file and scopes"""
+        return _load_flow(str(self.creds_dir / 'credentials.json'), tuple(self.SCOPES))
+    
+    def _needs_refresh(self, creds):
+        """Check whether the token is expired or close to expiring"""
+        if not creds.valid:
+            return True
+        # google-auth stores expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return creds.expiry is not None and creds.expiry - now < TOKEN_REFRESH_MARGIN
+    
+    def _refresh_token(self, token_path):
+        """Refresh the saved token under an exclusive lock shared by concurrent runs"""
+        lock_path = token_path.with_name(token_path.name + '.lock')
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have refreshed it while we waited for the lock
+                creds = Credentials.from_authorized_user_file(str(token_path), self.SCOPES)
+                if self._needs_refresh(creds):
+                    creds.refresh(Request())
+                    self._save_token(creds, token_path)
+                return creds
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    def _save_token(self, creds, token_path):
+        """Write the token atomically so readers never see a partial file"""
+        tmp_path = token_path.with_name(token_path.name + '.tmp')
+        with open(tmp_path, 'w') as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, token_path)
+    
+    def iter_unread_emails(self, limit=10, sender_filter=None, subject_filter=None, format='metadata'):
+        """Yield unread emails with optional filters as each batch arrives"""
         try:
             query = 'is:unread'
             if sender_filter:
@@ -96,54 +227,219 @@ class GmailAPI:
             if subject_filter:
                 query += f' subject:{subject_filter}'
             
-            results = self.service.users().messages().list(
-                userId='me', q=query, maxResults=limit).execute()
-            
-            messages = results.get('messages', [])
-            emails = []
-            
-            for message in messages:
-                msg = self.service.users().messages().get(
-                    userId='me', id=message['id']).execute()
-                
-                email_data = self._parse_email(msg)
-                emails.append(email_data)
-            
-            return emails
+            yield from self._iter_messages(self._iter_message_ids(query, limit), format=format)
             
         except HttpError as error:
-            print(f"❌ Error fetching emails: {error}")
-            return []
+            print(f"❌ Error fetching emails: {error}", file=sys.stderr)
     
-    def get_emails_by_filter(self, days=7, limit=50, query_filter=""):
-        """Get emails by custom filter within specified days"""
+    def get_unread_emails(self, limit=10, sender_filter=None, subject_filter=None, format='metadata'):
+        """Get unread emails with optional filters"""
+        return list(self.iter_unread_emails(limit, sender_filter, subject_filter, format))
+    
+    def iter_emails_by_filter(self, days=7, limit=50, query_filter="", format='metadata',
+                              unread_only=False, skip_processed=False):
+        """Yield emails by custom filter within specified days as each batch arrives"""
         try:
-            # Calculate date for filtering
-            since_date = datetime.now() - timedelta(days=days)
-            date_str = since_date.strftime('%Y/%m/%d')
+            # Calculate date for filtering in UTC so the window doesn't shift with local time
+            since_date = datetime.now(timezone.utc) - timedelta(days=days)
+            date_str = f"{since_date.year}/{since_date.month:02d}/{since_date.day:02d}"
             
+            # Let Gmail's index drop already-handled mail instead of fetching it
             query = f'after:{date_str}'
+            if unread_only:
+                query = f'is:unread {query}'
+            if skip_processed:
+                query += f' -label:{PROCESSED_LABEL}'
             if query_filter:
                 query += f' {query_filter}'
             
+            yield from self._iter_messages(self._iter_message_ids(query, limit), format=format)
+            
+        except HttpError as error:
+            print(f"❌ Error fetching emails: {error}", file=sys.stderr)
+    
+    def get_emails_by_filter(self, days=7, limit=50, query_filter="", format='metadata',
+                             unread_only=False, skip_processed=False):
+        """Get emails by custom filter within specified days"""
+        return list(self.iter_emails_by_filter(
+            days, limit, query_filter, format, unread_only, skip_processed))
+    
+    def get_full_message(self, message_id):
+        """Get a single email including its body"""
+        try:
+            return next(self._iter_messages([message_id], format='full'), None)
+        except HttpError as error:
+            print(f"❌ Error fetching email: {error}", file=sys.stderr)
+            return None
+    
+    def _iter_message_ids(self, query, limit):
+        """Yield up to limit message IDs matching query, following page tokens"""
+        page_token = None
+        fetched = 0
+        while fetched < limit:
             results = self.service.users().messages().list(
-                userId='me', q=query, maxResults=limit).execute()
+                userId='me', q=query, maxResults=min(PAGE_SIZE, limit - fetched),
+                pageToken=page_token).execute()
             
-            messages = results.get('messages', [])
-            emails = []
+            for message in results.get('messages', []):
+                fetched += 1
+                yield message['id']
             
-            for message in messages:
-                msg = self.service.users().messages().get(
-                    userId='me', id=message['id']).execute()
-                
-                email_data = self._parse_email(msg)
-                emails.append(email_data)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def _iter_messages(self, message_ids, format='metadata'):
+        """Yield parsed messages in order, serving cached ones from disk and batching the rest"""
+        ids = iter(message_ids)
+        first = list(islice(ids, BATCH_SIZE))
+        if not first:
+            return
+        peek = list(islice(ids, 1))
+        
+        if not peek:
+            cached = self._load_cached(first, need_body=(format == 'full'))
+            misses = [message_id for message_id in first if message_id not in cached]
+            yield from self._merge_fetched(first, cached, self._batch_get(misses, format), format)
+            return
+        
+        # More than one batch: switch to smaller pooled batches so at most
+        # MAX_IN_FLIGHT_REQUESTS sub-requests are outstanding and memory stays bounded
+        ids = chain(first, peek, ids)
+        chunks = iter(lambda: list(islice(ids, POOLED_BATCH_SIZE)), [])
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as pool:
+            pending = deque()
+            for chunk in chunks:
+                cached = self._load_cached(chunk, need_body=(format == 'full'))
+                misses = [message_id for message_id in chunk if message_id not in cached]
+                pending.append((chunk, cached, pool.submit(self._batch_get, misses, format, True)))
+                if len(pending) >= MAX_CONCURRENT_BATCHES:
+                    chunk, cached, future = pending.popleft()
+                    yield from self._merge_fetched(chunk, cached, future.result(), format)
             
-            return emails
+            while pending:
+                chunk, cached, future = pending.popleft()
+                yield from self._merge_fetched(chunk, cached, future.result(), format)
+    
+    def _batch_get(self, message_ids, format, own_connection=False):
+        """Fetch up to BATCH_SIZE messages in one batch request, keyed by ID"""
+        parsed = {}
+        if not message_ids:
+            return parsed
+        
+        kwargs = {'format': format}
+        if format == 'metadata':
+            kwargs['metadataHeaders'] = METADATA_HEADERS
+        
+        # Sub-requests that hit rate limits or server errors are re-batched with backoff
+        pending = list(message_ids)
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            if attempt:
+                time.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1) + random.uniform(0, RETRY_BASE_DELAY))
+            retry = []
             
-        except HttpError as error:
-            print(f"❌ Error fetching emails: {error}")
-            return []
+            def callback(request_id, response, exception):
+                if exception is None:
+                    parsed[request_id] = self._parse_email(response, parse_body=(format == 'full'))
+                elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                    retry.append(request_id)
+                else:
+                    # stderr keeps --format json output parseable line by line
+                    print(f"❌ Error fetching message {request_id}: {exception}", file=sys.stderr)
+                    self.failed_message_ids.append(request_id)
+            
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(self.service.users().messages().get(
+                    userId='me', id=message_id, **kwargs), request_id=message_id)
+            
+            if own_connection:
+                batch.execute(http=self._thread_http())
+            else:
+                batch.execute()
+            
+            pending = retry
+            if not pending:
+                break
+        
+        if pending:
+            print(f"❌ Giving up on {len(pending)} message(s) after {MAX_BATCH_RETRIES} retries",
+                  file=sys.stderr)
+            self.failed_message_ids.extend(pending)
+        return parsed
+    
+    def _thread_http(self):
+        """Per-thread authorized connection, kept alive across batches (httplib2 is not thread-safe)"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            # build_http applies the client's default socket timeout so a stalled batch can't hang the pool
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=build_http())
+            self._local.http = http
+        return http
+    
+    def _merge_fetched(self, message_ids, cached, fetched, format):
+        """Cache freshly fetched messages and yield the chunk in its original order"""
+        self._store_cached(fetched.values(), has_body=(format == 'full'))
+        cached.update(fetched)
+        for message_id in message_ids:
+            if message_id in cached:
+                yield cached[message_id]
+    
+    def _cache_db(self):
+        """Open the on-disk message cache, creating it on first use"""
+        if self._cache is None:
+            self._cache = sqlite3.connect(str(self.creds_dir / 'cache.db'), isolation_level=None)
+            self._cache.execute('PRAGMA journal_mode=WAL')
+            self._cache.execute(
+                'CREATE TABLE IF NOT EXISTS msgs ('
+                'id TEXT PRIMARY KEY, thread_id TEXT, snippet TEXT, headers_json TEXT, '
+                'body TEXT, is_html INTEGER, fetched_at REAL)')
+        return self._cache
+    
+    def _load_cached(self, message_ids, need_body=False):
+        """Return cached emails by ID; rows fetched as metadata have a NULL body"""
+        query = (f"SELECT id, thread_id, snippet, headers_json, body, is_html FROM msgs "
+                 f"WHERE id IN ({','.join('?' * len(message_ids))})")
+        if need_body:
+            query += ' AND body IS NOT NULL'
+        
+        cached = {}
+        rows = self._cache_db().execute(query, message_ids)
+        for message_id, thread_id, snippet, headers_json, body, is_html in rows:
+            # Match a fresh metadata fetch even if an earlier 'read' cached the body
+            cached[message_id] = {
+                'id': message_id,
+                'thread_id': thread_id,
+                'snippet': snippet,
+                **_json_loads(headers_json),
+                'body': body if need_body else '',
+                'is_html': bool(is_html) if need_body else False
+            }
+        return cached
+    
+    def _store_cached(self, emails, has_body=False):
+        """Persist parsed emails; message content is immutable so rows never expire"""
+        now = time.time()
+        rows = [(e['id'], e['thread_id'], e['snippet'],
+                 _json_dumps({k: e[k] for k in ('date', 'from', 'to', 'subject')}),
+                 e['body'] if has_body else None,
+                 e['is_html'] if has_body else None, now)
+                for e in emails]
+        if not rows:
+            return
+        
+        # Autocommit mode would commit (and sync the WAL) once per row
+        db = self._cache_db()
+        db.execute('BEGIN')
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO msgs '
+                '(id, thread_id, snippet, headers_json, body, is_html, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
     
     def send_email(self, to_email, subject, body, is_html=True, reply_to_id=None):
         """Send email via Gmail API"""
@@ -186,18 +482,49 @@ class GmailAPI:
     
     def mark_as_read(self, message_id):
         """Mark email as read"""
+        return self.mark_as_read_bulk([message_id])
+    
+    def mark_as_read_bulk(self, message_ids):
+        """Mark emails as read, up to MODIFY_BATCH_SIZE per request"""
         try:
-            self.service.users().messages().modify(
-                userId='me',
-                id=message_id,
-                body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            self._batch_modify(message_ids, {'removeLabelIds': ['UNREAD']})
+            return True
+        except HttpError as error:
+            print(f"❌ Error marking emails as read: {error}")
+            return False
+    
+    def mark_as_processed(self, message_ids):
+        """Label emails as handled so filtered agent runs skip them next time"""
+        try:
+            label_id = self._get_or_create_label(PROCESSED_LABEL)
+            self._batch_modify(message_ids, {'addLabelIds': [label_id]})
             return True
         except HttpError as error:
-            print(f"❌ Error marking email as read: {error}")
+            print(f"❌ Error labelling emails as processed: {error}")
             return False
     
-    def _parse_email(self, msg):
+    def _batch_modify(self, message_ids, label_changes):
+        """Apply the same label changes to many messages via batchModify"""
+        for start in range(0, len(message_ids), MODIFY_BATCH_SIZE):
+            self.service.users().messages().batchModify(
+                userId='me',
+                body={'ids': message_ids[start:start + MODIFY_BATCH_SIZE], **label_changes}
+            ).execute()
+    
+    def _get_or_create_label(self, name):
+        """Return the ID of a user label, creating it if missing"""
+        labels = self.service.users().labels().list(userId='me').execute()
+        for label in labels.get('labels', []):
+            if label['name'] == name:
+                return label['id']
+        
+        label = self.service.users().labels().create(
+            userId='me',
+            body={'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+        ).execute()
+        return label['id']
+    
+    def _parse_email(self, msg, parse_body=True):
         """Parse Gmail API message into structured data"""
         headers = msg['payload'].get('headers', [])
         
@@ -216,43 +543,52 @@ class GmailAPI:
         
         for header in headers:
             name = header['name'].lower()
-            if name == 'date':
-                email_data['date'] = header['value']
-            elif name == 'from':
-                email_data['from'] = header['value']
-            elif name == 'to':
-                email_data['to'] = header['value']
-            elif name == 'subject':
-                email_data['subject'] = header['value']
+            if name in self.WANTED_HEADERS:
+                email_data[name] = header['value']
         
-        # Extract body
-        email_data['body'] = self._get_message_body(msg['payload'])
+        # Extract body (listing commands only need the snippet)
+        if parse_body:
+            email_data['body'], body_type = self._get_message_body(msg['payload'])
+            email_data['is_html'] = body_type == 'text/html'
         
         return email_data
     
     def _get_message_body(self, payload):
-        """Extract email body from payload"""
-        body = ""
+        """Extract email body and its mimetype from payload, searching nested multiparts"""
+        # Collect every inline text leaf by mimetype; the first text/plain is often just a
+        # "view this email in your browser" stub ahead of the real text/html
+        candidates = {mime_type: [] for mime_type in BODY_MIME_PRIORITY}
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            stack.extend(part.get('parts', []))
+            
+            # Parts with a filename are attachments (e.g. log.txt), not the body
+            if part.get('filename'):
+                continue
+            data = part.get('body', {}).get('data')
+            if data and part.get('mimeType') in candidates:
+                candidates[part['mimeType']].append(data)
         
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-                    break
-                elif part['mimeType'] == 'text/html':
-                    data = part['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-                    break
-        else:
-            if payload['mimeType'] == 'text/plain':
-                data = payload['body']['data']
-                body = base64.urlsafe_b64decode(data).decode('utf-8')
-            elif payload['mimeType'] == 'text/html':
-                data = payload['body']['data']
-                body = base64.urlsafe_b64decode(data).decode('utf-8')
+        body, body_type = "", None
+        for mime_type in sorted(BODY_MIME_PRIORITY, key=BODY_MIME_PRIORITY.get):
+            if not candidates[mime_type]:
+                continue
+            text = _b64url_decode(max(candidates[mime_type], key=len)).decode('utf-8', errors='replace')
+            if body_type is None or self._is_stub_body(body, text):
+                body, body_type = text, mime_type
+            # Stop at the most preferred type that has more than a stub
+            if len(body.strip()) >= STUB_BODY_CHARS:
+                break
         
-        return body
+        return body, body_type
+    
+    def _is_stub_body(self, body, alternative):
+        """Check whether body is a placeholder for a much larger alternative part"""
+        stripped = body.strip()
+        if not stripped:
+            return True
+        return len(stripped) < STUB_BODY_CHARS and len(alternative) > STUB_SIZE_RATIO * len(stripped)
     
     def get_profile_info(self):
         """Get Gmail profile information"""
@@ -267,11 +603,34 @@ class GmailAPI:
             print(f"❌ Error getting profile: {error}")
             return None
 
+def print_emails(emails, summary, preview_chars=100, show_id=True, as_json=False):
+    """Print emails as they stream in, one write per email, then a count summary"""
+    if as_json:
+        # JSON lines for agent callers; no summary so every line parses
+        for email_data in emails:
+            sys.stdout.write(_json_dumps(email_data) + '\n')
+        return
+    
+    count = 0
+    for email_data in emails:
+        count += 1
+        lines = [
+            f"\n🔹 From: {email_data['from']}",
+            f"   Subject: {email_data['subject']}",
+            f"   Date: {email_data['date']}",
+            f"   Preview: {email_data['snippet'][:preview_chars]}..."
+        ]
+        if show_id:
+            lines.append(f"   ID: {email_data['id']}")
+        sys.stdout.write('\n'.join(lines) + '\n')
+    
+    print(f"\n{summary.format(count=count)}")
+
 def main():
     parser = argparse.ArgumentParser(description='Gmail API for ccOS Agents')
     parser.add_argument('command', choices=[
         'setup-check', 'unread', 'send', 'filter', 'profile', 
-        'mark-read', 'customer-support', 'investor-emails', 'auth-url', 'auth-code'
+        'mark-read', 'mark-processed', 'read', 'customer-support', 'investor-emails', 'auth-url', 'auth-code'
     ])
     parser.add_argument('--to', help='Recipient email for sending')
     parser.add_argument('--subject', help='Email subject')
@@ -281,7 +640,10 @@ def main():
     parser.add_argument('--days', type=int, default=7, help='Days to look back')
     parser.add_argument('--filter', help='Custom filter query')
     parser.add_argument('--sender', help='Filter by sender')
-    parser.add_argument('--message-id', help='Message ID to mark as read')
+    parser.add_argument('--message-id', help='Message ID to read, or comma-separated IDs to mark')
+    parser.add_argument('--unread-only', action='store_true', help='Only include unread emails')
+    parser.add_argument('--format', choices=['text', 'json'], default='text',
+                        help='Output format for email listings (json prints one object per line)')
     parser.add_argument('--code', help='Authorization code for manual OAuth')
     
     args = parser.parse_args()
@@ -307,77 +669,46 @@ def main():
             sys.exit(1)
     
     elif args.command == 'unread':
-        emails = gmail.get_unread_emails(
+        emails = gmail.iter_unread_emails(
             limit=args.limit,
             sender_filter=args.sender,
             subject_filter=args.filter
         )
-        
-        print(f"📧 Found {len(emails)} unread emails:")
-        for email_data in emails:
-            print(f"\n🔹 From: {email_data['from']}")
-            print(f"   Subject: {email_data['subject']}")
-            print(f"   Date: {email_data['date']}")
-            print(f"   Preview: {email_data['snippet'][:100]}...")
-            print(f"   ID: {email_data['id']}")
+        print_emails(emails, "📧 Found {count} unread emails", as_json=(args.format == 'json'))
     
     elif args.command == 'filter':
-        emails = gmail.get_emails_by_filter(
+        emails = gmail.iter_emails_by_filter(
             days=args.days,
             limit=args.limit,
-            query_filter=args.filter or ""
+            query_filter=args.filter or "",
+            unread_only=args.unread_only
         )
-        
-        print(f"📧 Found {len(emails)} emails matching filter:")
-        for email_data in emails:
-            print(f"\n🔹 From: {email_data['from']}")
-            print(f"   Subject: {email_data['subject']}")
-            print(f"   Date: {email_data['date']}")
-            print(f"   Preview: {email_data['snippet'][:100]}...")
+        print_emails(emails, "📧 Found {count} emails matching filter", show_id=False,
+                     as_json=(args.format == 'json'))
     
     elif args.command == 'customer-support':
         # Look for customer support emails
-        support_keywords = [
-            'support', 'help', 'issue', 'problem', 'bug', 'question',
-            'inquiry', 'contact', 'assistance', 'trouble'
-        ]
-        
-        filter_query = ' OR '.join([f'subject:{keyword}' for keyword in support_keywords])
-        emails = gmail.get_emails_by_filter(
+        emails = gmail.iter_emails_by_filter(
             days=args.days,
             limit=args.limit,
-            query_filter=filter_query
+            query_filter=CUSTOMER_SUPPORT_QUERY,
+            unread_only=args.unread_only,
+            skip_processed=True
         )
-        
-        print(f"🎧 Found {len(emails)} potential customer support emails:")
-        for email_data in emails:
-            print(f"\n🔹 From: {email_data['from']}")
-            print(f"   Subject: {email_data['subject']}")
-            print(f"   Date: {email_data['date']}")
-            print(f"   Preview: {email_data['snippet'][:150]}...")
-            print(f"   ID: {email_data['id']}")
+        print_emails(emails, "🎧 Found {count} potential customer support emails", preview_chars=150,
+                     as_json=(args.format == 'json'))
     
     elif args.command == 'investor-emails':
         # Look for investor-related emails
-        investor_keywords = [
-            'investment', 'funding', 'investor', 'venture', 'capital',
-            'partnership', 'acquisition', 'valuation', 'pitch', 'deck'
-        ]
-        
-        filter_query = ' OR '.join([f'subject:{keyword}' for keyword in investor_keywords])
-        emails = gmail.get_emails_by_filter(
+        emails = gmail.iter_emails_by_filter(
             days=args.days,
             limit=args.limit,
-            query_filter=filter_query
+            query_filter=INVESTOR_QUERY,
+            unread_only=args.unread_only,
+            skip_processed=True
         )
-        
-        print(f"💰 Found {len(emails)} potential investor emails:")
-        for email_data in emails:
-            print(f"\n🔹 From: {email_data['from']}")
-            print(f"   Subject: {email_data['subject']}")
-            print(f"   Date: {email_data['date']}")
-            print(f"   Preview: {email_data['snippet'][:150]}...")
-            print(f"   ID: {email_data['id']}")
+        print_emails(emails, "💰 Found {count} potential investor emails", preview_chars=150,
+                     as_json=(args.format == 'json'))
     
     elif args.command == 'send':
         if not args.to or not args.subject or not args.body:
@@ -404,12 +735,44 @@ def main():
             print("❌ Missing required argument: --message-id")
             sys.exit(1)
         
-        if gmail.mark_as_read(args.message_id):
-            print(f"✅ Email marked as read: {args.message_id}")
+        message_ids = [m.strip() for m in args.message_id.split(',') if m.strip()]
+        if gmail.mark_as_read_bulk(message_ids):
+            print(f"✅ {len(message_ids)} email(s) marked as read: {', '.join(message_ids)}")
         else:
             print(f"❌ Failed to mark email as read")
             sys.exit(1)
     
+    elif args.command == 'mark-processed':
+        if not args.message_id:
+            print("❌ Missing required argument: --message-id")
+            sys.exit(1)
+        
+        message_ids = [m.strip() for m in args.message_id.split(',') if m.strip()]
+        if gmail.mark_as_processed(message_ids):
+            print(f"✅ {len(message_ids)} email(s) labelled {PROCESSED_LABEL}: {', '.join(message_ids)}")
+        else:
+            print(f"❌ Failed to label emails as processed")
+            sys.exit(1)
+    
+    elif args.command == 'read':
+        if not args.message_id:
+            print("❌ Missing required argument: --message-id")
+            sys.exit(1)
+        
+        email_data = gmail.get_full_message(args.message_id)
+        if not email_data:
+            sys.exit(1)
+        
+        if args.format == 'json':
+            print(_json_dumps(email_data))
+        else:
+            print(f"🔹 From: {email_data['from']}")
+            print(f"   To: {email_data['to']}")
+            print(f"   Subject: {email_data['subject']}")
+            print(f"   Date: {email_data['date']}")
+            print(f"   Thread ID: {email_data['thread_id']}")
+            print(f"\n{email_data['body']}")
+    
     elif args.command == 'profile':
         profile = gmail.get_profile_info()
         if profile:
@@ -425,9 +788,7 @@ def main():
             print("❌ Gmail credentials not found!")
             sys.exit(1)
             
-        flow = InstalledAppFlow.from_client_secrets_file(
-            str(credentials_path), gmail.SCOPES)
-        flow.redirect_uri = 'http://localhost'
+        flow = gmail._flow()
         auth_url, _ = flow.authorization_url(prompt='consent')
         
         print("🌐 Manual OAuth Setup:")
@@ -442,20 +803,16 @@ def main():
             sys.exit(1)
             
         # Complete manual OAuth flow
-        credentials_path = gmail.creds_dir / 'credentials.json'
         token_path = gmail.creds_dir / 'token.json'
         
-        flow = InstalledAppFlow.from_client_secrets_file(
-            str(credentials_path), gmail.SCOPES)
-        flow.redirect_uri = 'http://localhost'
+        flow = gmail._flow()
         
         try:
             flow.fetch_token(code=args.code)
             creds = flow.credentials
             
             # Save credentials
-            with open(token_path, 'w') as token:
-                token.write(creds.to_json())
+            gmail._save_token(creds, token_path)
                 
             print("✅ Gmail API authentication successful!")
             print("🎯 Run './lib/gmail-fetch.sh setup-check' to verify")
@@ -463,6 +820,12 @@ def main():
         except Exception as e:
             print(f"❌ Authentication failed: {e}")
             sys.exit(1)
+    
+    # Listings omit messages that still failed after retries; don't let that pass as success
+    if gmail.failed_message_ids:
+        print(f"❌ {len(gmail.failed_message_ids)} email(s) could not be fetched: "
+              f"{', '.join(gmail.failed_message_ids)}", file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -13,13 +13,17 @@ if [[ -z "$COMMAND" ]]; then
     echo "Commands:"
     echo "  setup-check              - Verify Gmail API setup"
     echo "  unread [--limit N]       - Get unread emails"  
-    echo "  customer-support         - Find customer support emails"
-    echo "  investor-emails          - Find investor-related emails"
+    echo "  customer-support         - Find customer support emails (skips Processed-Agent)"
+    echo "  investor-emails          - Find investor-related emails (skips Processed-Agent)"
     echo "  send --to EMAIL --subject SUBJECT --body BODY"
-    echo "  mark-read --message-id ID"
-    echo "  filter --filter QUERY --days N"
+    echo "  mark-read --message-id ID[,ID...]"
+    echo "  mark-processed --message-id ID[,ID...] - Label as Processed-Agent"
+    echo "  read --message-id ID     - Show full email including body"
+    echo "  filter --filter QUERY --days N [--unread-only]"
     echo "  profile                  - Get account info"
     echo ""
+    echo "Listing commands and read accept --format json for one JSON object per line."
+    echo ""
     echo "Examples:"
     echo "  $0 setup-check"
     echo "  $0 unread --limit 5"